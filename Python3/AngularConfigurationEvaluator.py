@@ -5,17 +5,18 @@ Created on Sat Aug 21 03:23:35 2021
 @author: kpiqu
 """
 import numpy as np
-import math
-import stl
 from stl import mesh
 from matplotlib import pyplot
-from math import cos, sin, radians
+from matplotlib.colors import ListedColormap
+from matplotlib.patches import Patch
+from math import radians
 
 
 import vtk
+from vtk.util import numpy_support
 import argparse #Faltaría ponerlo que tb se pueda pasar argparse por aquí
 import itertools
-import vedo
+import multiprocessing
 
 
 def Matriz_Rotacion (axis, angle):
@@ -24,8 +25,8 @@ def Matriz_Rotacion (axis, angle):
     ----------
     axis : string
         String varible that especifies the axis in which the rotation matrix is going to be produced.
-    angle : float
-        The angle that is going to be rotated.
+    angle : float or np.array
+        The angle that is going to be rotated, in radians. An array of angles gives a stack of matrices.
 
     Raises
     ------
@@ -35,29 +36,44 @@ def Matriz_Rotacion (axis, angle):
     Returns
     -------
     matrix : np.array like matriz
-        DESCRIPTION.
+        3x3 rotation matrix, or a stack (...,3,3) of them if angle is an array.
 
     """
     
-    matrix = []
+    #The elements are written directly in the array, without building nested lists
+    angle = np.asarray(angle, dtype=np.float64)
+    c = np.cos(angle)
+    s = np.sin(angle)
+    matrix = np.zeros(angle.shape + (3,3))
     if 'x' == axis:
-        matrix = [[1,0,0],[0,cos(angle), sin(angle)],[0, -sin(angle),cos(angle)]]
+        matrix[...,0,0] = 1
+        matrix[...,1,1] = c
+        matrix[...,1,2] = s
+        matrix[...,2,1] = -s
+        matrix[...,2,2] = c
     elif 'y' == axis:
-        matrix = [[cos(angle),0, -sin(angle)],[0,1,0],[sin(angle),0 ,cos(angle)]]
+        matrix[...,0,0] = c
+        matrix[...,0,2] = -s
+        matrix[...,1,1] = 1
+        matrix[...,2,0] = s
+        matrix[...,2,2] = c
     elif 'z' == axis:
-        matrix = [[cos(angle), sin(angle),0],[-sin(angle),cos(angle), 0],[0,0,1]]
+        matrix[...,0,0] = c
+        matrix[...,0,1] = s
+        matrix[...,1,0] = -s
+        matrix[...,1,1] = c
+        matrix[...,2,2] = 1
     else:
         raise RuntimeError('Unknown axis %r, expected x, y or z' % axis)
-    
-    matrix = np.array(matrix)
+
     return matrix
 
-def mesh_to_vtkPolydata(obj):
+def mesh_to_vtkPolydata(vectors):
     """
     Parameters
     ----------
-    obj : mesh
-        Mesh type variable with the information of the solid.
+    vectors : np.array
+        (N,3,3) array with the vertices of the N triangles of the solid, as in mesh.vectors.
     
     Returns
     -------
@@ -65,11 +81,87 @@ def mesh_to_vtkPolydata(obj):
         VtkPolyDataObject type variable with the information of the solid..
 
     """
-    verts = list(itertools.chain(*(obj.vectors)))
-    faces = [[i*3, i*3+1, i*3+2] for i in range(len(verts)//3)]
-    vpoly = vedo.Mesh([verts, faces]).clean().polydata()
+    #Every triangle keeps its own three vertices. Duplicated vertices do not change
+    #the collision result, so there is no need to clean the mesh.
+    #The points are kept in float32, as in the STL file, so VTK stores them as VTK_FLOAT.
+    ntri = len(vectors)
+    verts = np.ascontiguousarray(vectors.reshape(-1,3), dtype=np.float32)
+    conn = np.column_stack([np.full(ntri,3), np.arange(3*ntri).reshape(ntri,3)]).ravel()
+    conn = conn.astype(numpy_support.ID_TYPE_CODE)
+    
+    points = vtk.vtkPoints()
+    points.SetData(numpy_support.numpy_to_vtk(verts))
+    cells = vtk.vtkCellArray()
+    cells.SetCells(ntri, numpy_support.numpy_to_vtkIdTypeArray(conn))
+    
+    vpoly = vtk.vtkPolyData()
+    vpoly.SetPoints(points)
+    vpoly.SetPolys(cells)
     return vpoly
 
+def Matriz_Transformacion(rotation_matrix, point=(0,0,0)):
+    """
+    Parameters
+    ----------
+    rotation_matrix : np.array
+        3x3 rotation matrix, as passed to mesh.rotate_using_matrix, or a stack (...,3,3) of them.
+    point : array like
+        Point around which the rotation is done, or a stack (...,3) of them.
+
+    Returns
+    -------
+    matrix : np.array
+        4x4 homogeneous matrix equivalent to mesh.rotate_using_matrix(rotation_matrix, point),
+        or a stack (...,4,4) of them. numpy-stl multiplies the row vectors from the left, 
+        hence the transpose.
+
+    """
+    rotation_matrix = np.asarray(rotation_matrix, dtype=float)
+    point = np.asarray(point, dtype=float)
+    transposed = np.swapaxes(rotation_matrix, -1, -2)
+    shape = np.broadcast_shapes(rotation_matrix.shape[:-2], point.shape[:-1])
+    matrix = np.zeros(shape + (4,4))
+    matrix[...,:3,:3] = transposed
+    matrix[...,:3,3] = point - np.matmul(transposed, point[...,None])[...,0]
+    matrix[...,3,3] = 1
+    return matrix
+
+def Matriz_Traslacion(translation):
+    """
+    Parameters
+    ----------
+    translation : array like
+        Translation vector (x, y, z), or a stack (...,3) of them.
+
+    Returns
+    -------
+    matrix : np.array
+        4x4 homogeneous matrix equivalent to mesh.translate(translation), or a stack (...,4,4) of them.
+
+    """
+    translation = np.asarray(translation, dtype=float)
+    matrix = np.zeros(translation.shape[:-1] + (4,4))
+    matrix[...] = np.identity(4)
+    matrix[...,:3,3] = translation
+    return matrix
+
+def fill_vtkMatrix(vmatrix, matrix):
+    """
+    Parameters
+    ----------
+    vmatrix : vtkMatrix4x4
+        VTK matrix of a collision filter, which is overwritten in place.
+    matrix : np.array
+        4x4 homogeneous matrix.
+
+    Returns
+    -------
+    None.
+
+    """
+    vmatrix.DeepCopy(matrix.ravel().tolist())
+    vmatrix.Modified()
+
 def get_program_parameters():
     import argparse
     description = 'Collision detection.'
@@ -82,41 +174,65 @@ def get_program_parameters():
     parser.add_argument('--fileCouch', dest='fileCouch', type=str)
     parser.add_argument('--fileBody', dest='fileBody', type=str)
     parser.add_argument('--RotPat', dest='RotPat',default=False, type=bool)
+    parser.add_argument('--Processes', dest='Processes', default=None, type=int, help='Number of processes for the sweep (default: number of CPUs)')
     args = parser.parse_args()
 
     return args
 
-def Choque(a,b):
+def collision_filter(vpoly,vpoly2):
     """
-    
-
     Parameters
     ----------
-    a : mesh
-        Mesh variable that is going to be analized.
-    
-    b : mesh
-        Mesh variable that is going to be analized.
-       
+    vpoly : VtkPolyDataObject
+        Polydata of the first solid, in its initial position.
+
+    vpoly2 : VtkPolyDataObject
+        Polydata of the second solid, in its initial position.
+
     Returns
     -------
-    Boolean object that especifies if there is a collision between those two stl files.
+    collide : vtkCollisionDetectionFilter
+        Collision filter between both solids. Its inputs do not change during the sweep,
+        so the OBB trees are built in the first Update() and reused afterwards. Its two
+        matrices are also created once, and Choque overwrites them in place.
 
     """
-                
-    vpoly = mesh_to_vtkPolydata(a)
-    vpoly2 = mesh_to_vtkPolydata(b)
-    
     collide = vtk.vtkCollisionDetectionFilter()
     collide.SetInputData(0, vpoly)
     collide.SetInputData(1, vpoly2)
-    collide.SetTransform(0, vtk.vtkTransform())
+    collide.SetMatrix(0, vtk.vtkMatrix4x4())
     collide.SetMatrix(1, vtk.vtkMatrix4x4())
     collide.SetBoxTolerance(0.0)
     collide.SetCellTolerance(0.0)
     collide.SetNumberOfCellsPerNode(2)
     collide.SetCollisionModeToFirstContact()
     collide.GenerateScalarsOn()
+    return collide
+
+def Choque(collide,Ta,Tb):
+    """
+    
+
+    Parameters
+    ----------
+    collide : vtkCollisionDetectionFilter
+        Collision filter between both solids, as returned by collision_filter.
+
+    Ta : np.array
+        4x4 transformation from the initial to the current position of the first solid.
+
+    Tb : np.array
+        4x4 transformation from the initial to the current position of the second solid.
+       
+    Returns
+    -------
+    Boolean object that especifies if there is a collision between those two stl files.
+
+    """
+    
+    #Only the transformations change between calls
+    fill_vtkMatrix(collide.GetMatrix(0), Ta)
+    fill_vtkMatrix(collide.GetMatrix(1), Tb)
     collide.Update()
       
     if collide.GetNumberOfContacts() > 0:
@@ -156,6 +272,154 @@ def find_mins_maxs(obj):
     maxz = obj.z.max()
     return minx, maxx, miny, maxy, minz, maxz
 
+def transform_mins_maxs(mins_maxs, matrix):
+    """
+    Parameters
+    ----------
+    mins_maxs : tuple
+        minx, maxx, miny, maxy, minz, maxz of the solid in its initial position, as returned by find_mins_maxs.
+    matrix : np.array
+        4x4 transformation from the initial to the current position of the solid.
+
+    Returns
+    -------
+    minx, maxx, miny, maxy, minz, maxz : float
+        Box enclosing the eight transformed corners. It contains the solid, although
+        it can be larger than its exact bounding box.
+
+    """
+    minx, maxx, miny, maxy, minz, maxz = mins_maxs
+    corners = np.array(list(itertools.product((minx,maxx),(miny,maxy),(minz,maxz))))
+    corners = np.dot(corners, matrix[:3,:3].T) + matrix[:3,3]
+    mins = corners.min(axis=0)
+    maxs = corners.max(axis=0)
+    return mins[0], maxs[0], mins[1], maxs[1], mins[2], maxs[2]
+
+def boxes_overlap(box, box2):
+    """
+    Parameters
+    ----------
+    box, box2 : tuple
+        minx, maxx, miny, maxy, minz, maxz of both solids, as returned by transform_mins_maxs.
+
+    Returns
+    -------
+    Boolean object that especifies if the boxes overlap. If they do not, the solids cannot collide.
+
+    """
+    ax0, ax1, ay0, ay1, az0, az1 = box
+    bx0, bx1, by0, by1, bz0, bz1 = box2
+    return not (ax1 < bx0 or bx1 < ax0 or ay1 < by0 or by1 < ay0 or az1 < bz0 or bz1 < az0)
+
+def vectors_mins_maxs(vectors):
+    """
+    Parameters
+    ----------
+    vectors : np.array
+        (N,3,3) array with the vertices of the N triangles of a solid.
+
+    Returns
+    -------
+    minx, maxx, miny, maxy, minz, maxz : float
+        The same bounding box as find_mins_maxs, computed from the bare vertices.
+
+    """
+    points = vectors.reshape(-1,3)
+    mins = points.min(axis=0)
+    maxs = points.max(axis=0)
+    return mins[0], maxs[0], mins[1], maxs[1], mins[2], maxs[2]
+
+def init_worker(gantry_vectors, couch_vectors, body_vectors, TGants, TCouchs, TBods):
+    """
+    Initialization of each process of the sweep. The VTK objects cannot be shared
+    between processes, so each of them builds its own polydata, collision filters and
+    bounding boxes from the vertices of the solids in their initial position.
+
+    Parameters
+    ----------
+    gantry_vectors, couch_vectors, body_vectors : np.array
+        (N,3,3) contiguous float32 arrays with the vertices of the solids in their initial position.
+    TGants : np.array
+        (36,36,4,4) transformations of the gantry for every gantry and couch angle.
+    TCouchs, TBods : np.array
+        (36,4,4) transformations of the couch and the body for every couch angle.
+
+    Returns
+    -------
+    None.
+
+    """
+    global gantry_couch, gantry_body, body_couch, gantry_box, couch_box, body_box
+    global TGantries, TCouches, TBodies
+    gantry_poly = mesh_to_vtkPolydata(gantry_vectors)
+    couch_poly = mesh_to_vtkPolydata(couch_vectors)
+    body_poly = mesh_to_vtkPolydata(body_vectors)
+    gantry_couch = collision_filter(gantry_poly, couch_poly)
+    gantry_body = collision_filter(gantry_poly, body_poly)
+    body_couch = collision_filter(body_poly, couch_poly)
+    gantry_box = vectors_mins_maxs(gantry_vectors)
+    couch_box = vectors_mins_maxs(couch_vectors)
+    body_box = vectors_mins_maxs(body_vectors)
+    TGantries = TGants
+    TCouches = TCouchs
+    TBodies = TBods
+
+def evaluate_body_couch(j):
+    """
+    Parameters
+    ----------
+    j : int
+        Index of the couch angle, in steps of 10 degrees.
+
+    Returns
+    -------
+    Boolean object that especifies if the body collides with the couch at this couch angle.
+    It does not depend on the gantry angle, so it is evaluated only once per couch angle.
+
+    """
+    TCouch = TCouches[j]
+    TBody = TBodies[j]
+    if not boxes_overlap(transform_mins_maxs(body_box, TBody), transform_mins_maxs(couch_box, TCouch)):
+        return False
+    return Choque(body_couch,TBody,TCouch)
+
+def evaluate_configuration(configuracion):
+    """
+    Parameters
+    ----------
+    configuracion : tuple
+        Indices (i, j) of the gantry and couch angles, in steps of 10 degrees, and the
+        result of evaluate_body_couch(j).
+
+    Returns
+    -------
+    i, j : int
+        The same indices, as the results arrive unordered.
+    HayChoque : bool
+        If there is a collision in this configuration.
+
+    """
+    i, j, HayChoque3 = configuracion
+    if HayChoque3:
+        return i, j, True
+    
+    #The meshes are not moved: the transformation of each solid from its initial
+    #position, computed beforehand, is handed to the collision filter.
+    TGantry = TGantries[i,j]
+    TCouch = TCouches[j]
+    TBody = TBodies[j]
+    
+    #Broad phase: each box is transformed once, and the collision filter only runs
+    #for the pairs whose boxes overlap
+    gbox = transform_mins_maxs(gantry_box, TGantry)
+    cbox = transform_mins_maxs(couch_box, TCouch)
+    bbox = transform_mins_maxs(body_box, TBody)
+    
+    #We evaluate if there is a collision, starting with the gantry and the patient
+    HayChoque = ((boxes_overlap(gbox, bbox) and Choque(gantry_body,TGantry,TBody))
+                 or (boxes_overlap(gbox, cbox) and Choque(gantry_couch,TGantry,TCouch)))
+    
+    return i, j, HayChoque
 
 
 
@@ -189,7 +453,6 @@ def main():
         body.rotate_using_matrix(MatrizPrueba)
     
     #We evaluate the body and we locate the couch underneath it.
-    bvolume, bcog, binertia = body.get_mass_properties()
     body.translate(-veciso)
     
     bminx, bmaxx, bminy, bmaxy, bminz, bmaxz = find_mins_maxs(body)
@@ -198,64 +461,57 @@ def main():
     bh1 = bmaxz - bminz
     
     global poscouch
-    poscouch = [0,0,-bh1/1.5] 
+    poscouch = np.array([0,0,-bh1/1.5])
     
     cvolume, ccog, cinertia = couch.get_mass_properties()
     couch.translate(-ccog + poscouch-veciso)
-    cvolume, ccog, cinertia = couch.get_mass_properties()#we locate the final center of gravity of the couch
+    ccog = poscouch -veciso#the translation takes the center of gravity of the couch to its final position
     couch.rotate_using_matrix(Matriz_Rotacion('z',angcouch),ccog) 
     
+    #All the transformations of the sweep are computed beforehand, every 10 degrees
+    angulos = np.radians(np.arange(36)*10)
+    GMatrices = Matriz_Rotacion('y',angulos)
+    CMatrices = Matriz_Rotacion('z',angulos)
+    
+    #We allow the couch-body to rotate: shape (36,4,4), index j of the couch angle
+    TCouches = Matriz_Transformacion(CMatrices,ccog)
+    TBodies = Matriz_Transformacion(CMatrices,ccog -poscouch)
+    
+    #As the isocenter moves the gantry has to translate. Once the gantry has been translated 
+    #above the isocenter, we allow it to move: shape (36,36,4,4), indices i, j of gantry and couch angles
+    newvecisos = np.matmul(CMatrices,veciso)
+    TGantries = np.matmul(Matriz_Transformacion(GMatrices)[:,None], Matriz_Traslacion(newvecisos-veciso)[None,:])
+    
+    #Every configuration is independent, so the sweep is distributed among several processes.
+    #Each process builds once the polydata and bounding boxes from this initial position.
+    #Only the vertices are sent, as contiguous arrays apart from the normals and attributes of the STL records.
+    initargs = (np.ascontiguousarray(gantry.vectors, dtype=np.float32),
+                np.ascontiguousarray(couch.vectors, dtype=np.float32),
+                np.ascontiguousarray(body.vectors, dtype=np.float32),
+                TGantries, TCouches, TBodies)
     
     RegVali=[]
     RegNoVali = []
     cont = 0
-    for i in range(36):#This will count the gantry angle (from 0 to 359)
-        for j in range(36):#This will count the couch angle (from 0 to 359) 
+    Colisiones = np.zeros((36,36), dtype=bool)
+    with multiprocessing.Pool(args.Processes, initializer=init_worker, initargs=initargs) as pool:
+        #The body and the couch rotate together, so their collision only depends on the couch angle
+        ChoqueCuerpoCamilla = pool.map(evaluate_body_couch, range(36))
+        #gantry and couch angles (from 0 to 359)
+        configuraciones = ((i, j, ChoqueCuerpoCamilla[j]) for i, j in itertools.product(range(36), range(36)))
+        for i, j, HayChoque in pool.imap_unordered(evaluate_configuration, configuraciones, chunksize=8):
             
             PAngG=i*10
-            print(PAngG)
             PAngC= j*10
-            
-            #We allow the couch-body to rotate
-    
-            CMatriz = Matriz_Rotacion('z',math.radians(PAngC))
-            CMatriz = np.array(CMatriz)
-            
-            couch.rotate_using_matrix(CMatriz,ccog)
-            body.rotate_using_matrix(CMatriz,ccog -poscouch)    
-            CMatrizInv= np.linalg.inv(CMatriz) 
-            
-                    
-            #As the isocenter moves the gantry has to translate
-            newveciso = np.dot(CMatriz,veciso)
-            gantry.translate(newveciso-veciso) 
-            #Once the gantry has been translated above the isocenter, now we allow it to move.
-            GMatriz = Matriz_Rotacion('y',math.radians(PAngG))
-            GMatriz = np.array(GMatriz)
-            gantry.rotate_using_matrix(GMatriz)
-            GMatrizInv= np.linalg.inv(GMatriz) 
-            
-            #We evaluate if there is a collision
-            HayChoque1 = Choque(gantry,couch)
-            HayChoque2 = Choque(gantry,body)
-            HayChoque3 = Choque(body,couch)
-            HayChoque = HayChoque1 or HayChoque2 or HayChoque3
-            print(HayChoque)
-            
+            print(PAngG, PAngC, HayChoque)
     
+            Colisiones[i,j] = HayChoque
             if HayChoque== False:
                 RegVali.append([PAngG,PAngC])
             else:
                 RegNoVali.append([PAngG,PAngC])
                 
             cont = cont + 1
-            
-            #Once we have finished evaluating the configuration, we reset the sistem to his original configuration
-            
-            gantry.rotate_using_matrix(GMatrizInv)
-            gantry.translate(-newveciso+veciso)
-            couch.rotate_using_matrix(CMatrizInv, ccog)    
-            body.rotate_using_matrix(CMatrizInv, ccog -poscouch) 
     
     
     #Now we calculate the percentajes of configurations
@@ -267,23 +523,17 @@ def main():
     fig = pyplot.figure()
     ax = fig.add_subplot(111)
     
-    data = np.array(RegVali)
-    xval, yval = data.T
-    datano = np.array(RegNoVali)
-    xnoval, ynoval = datano.T
-    
-    pyplot.scatter(xval,yval,c='b', marker = 's',linewidth=0.01 , label=f'No hay colisión {PorcentajeValido:,.0f} %')
-    pyplot.scatter(xnoval,ynoval,c='r', marker = 's',linewidth=0.01 , label=f'Hay colisión {PorcentajeNoValido:,.0f} %')
-    
-    ratio = 1.0
-    xleft, xright = ax.get_xlim()
-    ybottom, ytop = ax.get_ylim()
-    ax.set_aspect(abs((xright-xleft)/(ybottom-ytop))*ratio)
+    #Each configuration is a 10x10 degrees cell centred on its angles, blue if valid and red if not
+    bordes = np.arange(37)*10 - 5
+    ax.pcolormesh(bordes, bordes, Colisiones.T.astype(int), cmap=ListedColormap(['b','r']), vmin=0, vmax=1, shading='flat')
+    ax.legend(handles=[Patch(color='b', label=f'No hay colisión {PorcentajeValido:,.0f} %'),
+                       Patch(color='r', label=f'Hay colisión {PorcentajeNoValido:,.0f} %')],
+              bbox_to_anchor=(0.4, 1.15))
+    ax.set_aspect('equal')
     
     
     pyplot.xlabel("Ángulo del gantry")
     pyplot.ylabel("Ángulo de la camilla")
-    pyplot.legend(bbox_to_anchor=(0.4, 1.15));
     pyplot.show()
 
 
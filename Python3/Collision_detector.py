@@ -11,14 +11,13 @@ import stl
 from stl import mesh
 from mpl_toolkits import mplot3d
 from matplotlib import pyplot
-from math import cos, sin, radians
+from math import radians
 import tkinter as tk
 from tkinter import *
 
 
 import vtk
 import argparse
-import itertools
 import vedo
 import threading
 
@@ -46,8 +45,8 @@ def Matriz_Rotacion (axis, angle):
     ----------
     axis : string
         String varible that especifies the axis in which the rotation matrix is going to be produced.
-    angle : float
-        The angle that is going to be rotated.
+    angle : float or np.array
+        The angle that is going to be rotated, in radians. An array of angles gives a stack of matrices.
 
     Raises
     ------
@@ -57,21 +56,36 @@ def Matriz_Rotacion (axis, angle):
     Returns
     -------
     matrix : np.array like matriz
-        DESCRIPTION.
+        3x3 rotation matrix, or a stack (...,3,3) of them if angle is an array.
 
     """
 
-    matrix = []
+    #The elements are written directly in the array, without building nested lists
+    angle = np.asarray(angle, dtype=np.float64)
+    c = np.cos(angle)
+    s = np.sin(angle)
+    matrix = np.zeros(angle.shape + (3,3))
     if 'x' == axis:
-        matrix = [[1,0,0],[0,cos(angle), sin(angle)],[0, -sin(angle),cos(angle)]]
+        matrix[...,0,0] = 1
+        matrix[...,1,1] = c
+        matrix[...,1,2] = s
+        matrix[...,2,1] = -s
+        matrix[...,2,2] = c
     elif 'y' == axis:
-        matrix = [[cos(angle),0, -sin(angle)],[0,1,0],[sin(angle),0 ,cos(angle)]]
+        matrix[...,0,0] = c
+        matrix[...,0,2] = -s
+        matrix[...,1,1] = 1
+        matrix[...,2,0] = s
+        matrix[...,2,2] = c
     elif 'z' == axis:
-        matrix = [[cos(angle), sin(angle),0],[-sin(angle),cos(angle), 0],[0,0,1]]
+        matrix[...,0,0] = c
+        matrix[...,0,1] = s
+        matrix[...,1,0] = -s
+        matrix[...,1,1] = c
+        matrix[...,2,2] = 1
     else:
         raise RuntimeError('Unknown axis %r, expected x, y or z' % axis)
 
-    matrix = np.array(matrix)
     return matrix
 
 def rotate_using_matrix(self, rotation_matrix, point=None):
@@ -156,11 +170,22 @@ def mesh_to_vtkPolydata(obj):
         VtkPolyDataObject type variable with the information of the solid..
 
     """
-    verts = list(itertools.chain(*(obj.vectors)))
-    faces = [[i*3, i*3+1, i*3+2] for i in range(len(verts)//3)]
+    verts = obj.vectors.reshape(-1,3).astype(np.float32, copy=False)
+    faces = np.arange(verts.shape[0], dtype=np.int64).reshape(-1,3)
     vpoly = vedo.Mesh([verts, faces]).clean().polydata()
     return vpoly
 
+#The collision filter and its identity transformations are created only once and
+#shared by every call to Choque, which only changes the inputs.
+_collide = vtk.vtkCollisionDetectionFilter()
+_collide.SetTransform(0, vtk.vtkTransform())
+_collide.SetMatrix(1, vtk.vtkMatrix4x4())
+_collide.SetBoxTolerance(0.0)
+_collide.SetCellTolerance(0.0)
+_collide.SetNumberOfCellsPerNode(2)
+_collide.SetCollisionModeToFirstContact()
+_collide.GenerateScalarsOn()
+
 def Choque(a,b):
     """
     Parameters
@@ -176,23 +201,21 @@ def Choque(a,b):
     Boolean object that especifies if there is a collision between those two stl files.
 
     """
+    #Broad phase: if the bounding boxes do not overlap, the solids cannot collide
+    ax0, ax1, ay0, ay1, az0, az1 = find_mins_maxs(a)
+    bx0, bx1, by0, by1, bz0, bz1 = find_mins_maxs(b)
+    if ax1 < bx0 or bx1 < ax0 or ay1 < by0 or by1 < ay0 or az1 < bz0 or bz1 < az0:
+        return False
+
     a = mesh_to_vtkPolydata(a)
     b = mesh_to_vtkPolydata(b)
 
     #Calculamos si se realiza la colisión
-    collide = vtk.vtkCollisionDetectionFilter()
-    collide.SetInputData(0, a)
-    collide.SetInputData(1, b)
-    collide.SetTransform(0, vtk.vtkTransform())
-    collide.SetMatrix(1, vtk.vtkMatrix4x4())
-    collide.SetBoxTolerance(0.0)
-    collide.SetCellTolerance(0.0)
-    collide.SetNumberOfCellsPerNode(2)
-    collide.SetCollisionModeToFirstContact()
-    collide.GenerateScalarsOn()
-    collide.Update()
-
-    if collide.GetNumberOfContacts() > 0:
+    _collide.SetInputData(0, a)
+    _collide.SetInputData(1, b)
+    _collide.Update()
+
+    if _collide.GetNumberOfContacts() > 0:
         return True
     else:
         return False
@@ -280,7 +303,10 @@ def update_figure(wix,wiy,wiz,wpx,wpy,w1,w2):
     couch.translate(-veciso -vecpac)
     body.translate(-veciso)
 
-    cvolume, ccog, cinertia = couch.get_mass_properties()
+    #The center of gravity of the couch moves with it, there is no need to recompute it from the mesh
+    global ccouch
+    ccouch = ccouch -veciso -vecpac
+    ccog = ccouch
 
     #Now, we allow the couch-body sistem to move
 
@@ -291,7 +317,8 @@ def update_figure(wix,wiy,wiz,wpx,wpy,w1,w2):
 
     couch.rotate_using_matrix(CMatriz,ccog)
     body.rotate_using_matrix(CMatriz,ccog -poscouch)
-    CMatrizInv= np.linalg.inv(CMatriz)
+    #Rotation matrices are orthogonal, so the inverse is the transpose
+    CMatrizInv= CMatriz.T
 
     #As the isocenter moves the gantry has to translate
     newveciso = np.dot(CMatriz,veciso)
@@ -301,14 +328,12 @@ def update_figure(wix,wiy,wiz,wpx,wpy,w1,w2):
     GMatriz = Matriz_Rotacion('y',math.radians(w1.get()))
     GMatriz = np.array(GMatriz)
     gantry.rotate_using_matrix(GMatriz)
-    GMatrizInv= np.linalg.inv(GMatriz)
+    GMatrizInv= GMatriz.T
 
 
-    #We evaluate if there is a collision
-    HayChoque1 = Choque(gantry,couch)
-    HayChoque2 = Choque(gantry,body)
-    HayChoque3 = Choque(body,couch)
-    HayChoque = HayChoque1 or HayChoque2 or HayChoque3
+    #We evaluate if there is a collision. The first collision found is enough, so the
+    #gantry and the patient, the most frequent one, are tested first.
+    HayChoque = Choque(gantry,body) or Choque(gantry,couch) or Choque(body,couch)
 
     if HayChoque==False:
         print("No collision in this configuration")
@@ -344,6 +369,7 @@ def update_figure(wix,wiy,wiz,wpx,wpy,w1,w2):
     body.rotate_using_matrix(CMatrizInv, ccog -poscouch)
     couch.translate(+veciso)
     body.translate(+veciso)
+    ccouch = ccouch +veciso
 
 def main():
 
@@ -368,7 +394,6 @@ def main():
         body.rotate_using_matrix(MatrizPrueba)
 
     #We evaluate the body and we locate the couch underneath it.
-    bvolume, bcog, binertia = body.get_mass_properties()
     body.translate(-posisocent)
 
     bminx, bmaxx, bminy, bmaxy, bminz, bmaxz = find_mins_maxs(body)
@@ -381,8 +406,10 @@ def main():
 
     cvolume, ccog, cinertia = couch.get_mass_properties()
     couch.translate(-ccog + poscouch -posisocent)
-    cvolume, ccog, cinertia = couch.get_mass_properties()
-    couch.rotate_using_matrix(Matriz_Rotacion('z',angcouch),ccog)
+    #The translation moves the center of gravity to poscouch -posisocent, and the rotation around it keeps it there
+    global ccouch
+    ccouch = poscouch -posisocent
+    couch.rotate_using_matrix(Matriz_Rotacion('z',angcouch),ccouch)
 
     MatrizPrueba = Matriz_Rotacion('y', anggantry)
     gantry.rotate_using_matrix(MatrizPrueba,[0,0,0])
@@ -120,25 +120,32 @@
 from math import cos, sin, radians, degrees, sqrt, acos, atan2
 import os
 import re
-import itertools
 from collections import OrderedDict
 
 # Import RayStation modules and WinForms for GUI
-from connect import get_current, await_user_input
+from connect import get_current, await_user_input, CompositeAction
 import clr
 clr.AddReference("System.Windows.Forms")
 clr.AddReference("System.Drawing")
 import threading
 import platform
-from System.Windows.Forms import Application, Form, Label, ComboBox, Button, TextBox, TrackBar, FormStartPosition, TickStyle, Keys, CheckBox, GroupBox#, DataGridView
+from System.Windows.Forms import Application, Form, Label, ComboBox, Button, TextBox, TrackBar, FormStartPosition, TickStyle, Keys, CheckBox, GroupBox, Timer#, DataGridView
 from System.Drawing import Point, Size, Color#, SolidBrush, Graphics
+from System import Action
 from System.Threading import ParameterizedThreadStart, ThreadStart, Thread, ThreadInterruptedException, ThreadAbortException, SpinWait
 
 
-class Part:
+# Text of every integer value the sliders can take, from the couch z minimum to the snout extraction maximum,
+# so that moving a slider does not create a new string at each tick
+SLIDER_TEXT = dict((i, str(i)) for i in range(-500, 801))
+
+
+class Part(object):
     """
     Class describing a 3D model file, that might be a part of the whole machine (treatment head or couch)
     """
+    # Fixed attributes, as they are read for every part at each transformation. cb is the CheckBox of SelectPartsForm
+    __slots__ = ('name', 'filename', 'color', 'active', 'moveX', 'moveY', 'moveZ', 'move_mask', 'scissor', 'retractable', 'roi', 'cb')
 
     def __init__(self, name, filename, color, active, movex=True, movey=True, movez=True, scissor=False, retractable=False):
         """
@@ -160,14 +167,17 @@ class Part:
         self.moveX = movex
         self.moveY = movey
         self.moveZ = movez
+        self.move_mask = (1 if movex else 0, 1 if movey else 0, 1 if movez else 0)  # Multiplies a couch displacement, to drop the fixed axes
         self.scissor = scissor
         self.retractable = retractable
+        self.roi = None  # The RayStation ROI of this part, once imported
 
 
-class Machine:
+class Machine(object):
     """
     Class grouping different Parts into the same machine, e.g. a treatment head or a couch
     """
+    __slots__ = ('name', 'path', 'parts', 'active_parts')
 
     def __init__(self, name, path, parts):
         """
@@ -179,6 +189,7 @@ class Machine:
         self.name = name
         self.path = path
         self.parts = parts
+        self.active_parts = [p for p in parts if p.active]  # Updated once the user selects the parts, see main()
 
 
 class SelectListForm(Form):
@@ -303,10 +314,33 @@ class TuneModelsForm(Form):
         colheight = maxColThreads*colrowheight
         colmargin = 75
         colheightex = colheight + colmargin  # margin
-        self.Size = Size(500, 575+colheightex if extraction else 475+colheightex)  # Set the size of the form
+        self.Size = Size(500, 605+colheightex if extraction else 505+colheightex)  # Set the size of the form
         self.Text = 'Tune 3D model positions'  # Set title of the form
         self.TopMost = True
 
+        # Values of the last transformation applied to the models, and of the last one handed to the
+        # transformation worker, see transform()
+        self.last_request = None
+        self.queued_request = None
+        # Set while update_sliders() moves the trackbars, so that their handlers ignore it
+        self.updating_sliders = False
+
+        # Add a timer that delays the transformation until the sliders stop moving, so that dragging
+        # a slider does not transform the models at every intermediate value
+        self.timer = Timer()
+        self.timer.Interval = 150  # ms
+        self.timer.Tick += self.timer_tick
+
+        # Transform the models on a single worker thread, so that the form keeps responding meanwhile.
+        # transform() leaves only the latest request in pending_request, see transform_loop()
+        self.transform_condition = threading.Condition()
+        self.pending_request = None
+        self.transforming = False
+        self.closing = False
+        self.transform_worker = Thread(ThreadStart(self.transform_loop))
+        self.transform_worker.IsBackground = True
+        self.transform_worker.Start()
+
         # Add a beam label
         label_b = Label()
         label_b.Text = 'Please select a beam angle in DEG [0:360].'
@@ -318,7 +352,7 @@ class TuneModelsForm(Form):
         self.tboxB = TextBox()
         self.tboxB.Location = Point(15, 60)
         self.tboxB.Width = 55
-        self.tboxB.Text = "0"
+        self.tboxB.Text = "{:g}".format(degrees(gangle))  # The models are imported at this angle, see main()
         self.tboxB.KeyDown += self.on_enter
         self.Controls.Add(self.tboxB)
 
@@ -328,7 +362,7 @@ class TuneModelsForm(Form):
         self.tbB.TickFrequency = 10
         self.tbB.Minimum = 0
         self.tbB.Maximum = 360
-        self.tbB.Value = 0
+        self.tbB.Value = int(round(degrees(gangle)))
         self.tbB.Size = Size(360, 25)
         self.tbB.Location = Point(100, 60-5)
         self.tbB.ValueChanged += self.updatetbox_b
@@ -345,7 +379,7 @@ class TuneModelsForm(Form):
         self.tboxC = TextBox()
         self.tboxC.Location = Point(15, 160)
         self.tboxC.Width = 55
-        self.tboxC.Text = "0"
+        self.tboxC.Text = "{:g}".format(degrees(cangle))
         self.tboxC.KeyDown += self.on_enter
         self.Controls.Add(self.tboxC)
 
@@ -355,7 +389,7 @@ class TuneModelsForm(Form):
         self.tbC.TickFrequency = 5
         self.tbC.Minimum = -90
         self.tbC.Maximum = 90
-        self.tbC.Value = 0
+        self.tbC.Value = int(round(degrees(cangle)))
         self.tbC.Size = Size(360, 25)
         self.tbC.Location = Point(100, 160-5)
         self.tbC.ValueChanged += self.updatetbox_c
@@ -416,7 +450,7 @@ class TuneModelsForm(Form):
         self.tboxZ.KeyDown += self.on_enter
         self.Controls.Add(self.tboxZ)
 
-        # Add a trackbar to slide to the desired couch y position
+        # Add a trackbar to slide to the desired couch z position
         self.tbZ = TrackBar()
         self.tbZ.TickStyle = TickStyle.Both
         self.tbZ.TickFrequency = 100
@@ -438,7 +472,7 @@ class TuneModelsForm(Form):
             label_ext.AutoSize = True
             self.Controls.Add(label_ext)
 
-            # Add a text box to write the desired couch x position
+            # Add a text box to write the desired snout extraction
             self.tboxE = TextBox()
             self.tboxE.Location = Point(15, 440)
             self.tboxE.Width = 55
@@ -446,7 +480,7 @@ class TuneModelsForm(Form):
             self.tboxE.KeyDown += self.on_enter
             self.Controls.Add(self.tboxE)
 
-            # Add a trackbar to slide to the desired couch x position
+            # Add a trackbar to slide to the desired snout extraction
             self.tbE = TrackBar()
             self.tbE.TickStyle = TickStyle.Both
             self.tbE.TickFrequency = 40
@@ -460,6 +494,11 @@ class TuneModelsForm(Form):
 
             lastpos = 440
 
+        # Text boxes paired with their trackbar, in the order transform() reads them
+        self.fields = [(self.tboxB, self.tbB), (self.tboxC, self.tbC), (self.tboxX, self.tbX), (self.tboxY, self.tbY), (self.tboxZ, self.tbZ)]
+        if extraction:
+            self.fields.append((self.tboxE, self.tbE))
+
         # Add now a collision report box
         col_box = GroupBox()
         col_box.Text = 'Collision report (increases CPU load of server)'
@@ -485,6 +524,9 @@ class TuneModelsForm(Form):
         dscl.AutoSize = True
         col_box.Controls.Add(dscl)
 
+        # ROI names offered in the collision pair boxes, read once from RayStation for all rows
+        roi_names = [" "] + [r.Name for r in case.PatientModel.RegionsOfInterest]
+
         for row in range(maxColThreads):
             y_pos = row * colrowheight + 40
 
@@ -497,14 +539,15 @@ class TuneModelsForm(Form):
             col_box.Controls.Add(cb)
             self.col_cb.append(cb)
 
-            # Add a ComboBox that will display the ROIs to perform collision detection on (roiA vs roiB)
+            # Add a ComboBox that will display the ROIs to perform collision detection on (roiA vs roiB).
+            # Each box gets its own copy of the list, as boxes bound to the same list would share their selection
             boxa = ComboBox()
-            boxa.DataSource = [" "]+[r.Name for r in case.PatientModel.RegionsOfInterest]
+            boxa.DataSource = list(roi_names)
             boxa.Location = Point(35, y_pos)
             boxa.Size = Size(100, colrowheight)
             # boxA.SelectedIndexChanged += self.apply_button_clicked
             boxb = ComboBox()
-            boxb.DataSource = [" "] + [r.Name for r in case.PatientModel.RegionsOfInterest]
+            boxb.DataSource = list(roi_names)
             boxb.Location = Point(140, y_pos)
             boxb.Size = Size(100, colrowheight)
             # boxB.SelectedIndexChanged += self.apply_button_clicked
@@ -579,6 +622,14 @@ class TuneModelsForm(Form):
         button2.Click += self.exit_button_clicked
         self.Controls.Add(button2)
 
+        # Add a check box to transform the models while the sliders move. If unchecked, only Apply or Enter transform them
+        self.cb_live = CheckBox()
+        self.cb_live.Text = 'Live update'
+        self.cb_live.Checked = True
+        self.cb_live.AutoSize = True
+        self.cb_live.Location = Point(15, lastpos+85)
+        self.Controls.Add(self.cb_live)
+
     def on_enter(self, _sender, args):
         """
         Method invoked when a key is pressed within a textbox. It calls transform() if this key is enter
@@ -587,66 +638,99 @@ class TuneModelsForm(Form):
         :param args: contains the pressed key event
         """
         if args.KeyCode == Keys.Enter:
+            self.timer.Stop()  # supersedes any pending slider transformation
             self.transform()
 
     def updatetbox_b(self, _sender, _event):
         """
-        Method invoked when the beam angle slider is moved. Updates the text box and calls transform()
+        Method invoked when the beam angle slider is moved. Updates the text box and calls transform() once the slider stops
         :param self: the reference to the Form
         :param _sender:  ignore
         :param _event: ignore
         """
-        self.tboxB.Text = str(self.tbB.Value)
-        self.transform()
+        if self.updating_sliders:
+            return
+        self.tboxB.Text = SLIDER_TEXT[self.tbB.Value]
+        self.restart_timer()
 
     def updatetbox_c(self, _sender, _event):
         """
-        Method invoked when the couch angle slider is moved. Updates the text box and calls transform()
+        Method invoked when the couch angle slider is moved. Updates the text box and calls transform() once the slider stops
         :param self: the reference to the Form
         :param _sender:  ignore
         :param _event: ignore
         """
-        self.tboxC.Text = str(self.tbC.Value)
-        self.transform()
+        if self.updating_sliders:
+            return
+        self.tboxC.Text = SLIDER_TEXT[self.tbC.Value]
+        self.restart_timer()
 
     def updatetbox_x(self, _sender, _event):
         """
-        Method invoked when the x slider is moved. Updates the text box and calls transform()
+        Method invoked when the x slider is moved. Updates the text box and calls transform() once the slider stops
         :param self: the reference to the Form
         :param _sender:  ignore
         :param _event: ignore
         """
-        self.tboxX.Text = str(self.tbX.Value)
-        self.transform()
+        if self.updating_sliders:
+            return
+        self.tboxX.Text = SLIDER_TEXT[self.tbX.Value]
+        self.restart_timer()
 
     def updatetbox_y(self, _sender, _event):
         """
-        Method invoked when the y slider is moved. Updates the text box and calls transform()
+        Method invoked when the y slider is moved. Updates the text box and calls transform() once the slider stops
         :param self: the reference to the Form
         :param _sender:  ignore
         :param _event: ignore
         """
-        self.tboxY.Text = str(self.tbY.Value)
-        self.transform()
+        if self.updating_sliders:
+            return
+        self.tboxY.Text = SLIDER_TEXT[self.tbY.Value]
+        self.restart_timer()
 
     def updatetbox_z(self, _sender, _event):
         """
-        Method invoked when the z slider is moved. Updates the text box and calls transform()
+        Method invoked when the z slider is moved. Updates the text box and calls transform() once the slider stops
         :param self: the reference to the Form
         :param _sender:  ignore
         :param _event: ignore
         """
-        self.tboxZ.Text = str(self.tbZ.Value)
-        self.transform()
+        if self.updating_sliders:
+            return
+        self.tboxZ.Text = SLIDER_TEXT[self.tbZ.Value]
+        self.restart_timer()
 
     def updatetbox_e(self, _sender, _event):
         """
-        Method invoked when the extraction slider is moved. Updates the text box and calls transform()
+        Method invoked when the extraction slider is moved. Updates the text box and calls transform() once the slider stops
         :param self: the reference to the Form
         :param _sender:  ignore
         :param _event: ignore
         """
-        self.tboxE.Text = str(self.tbE.Value)
+        if self.updating_sliders:
+            return
+        self.tboxE.Text = SLIDER_TEXT[self.tbE.Value]
+        self.restart_timer()
+
+    def restart_timer(self):
+        """
+        Restart the timer, so that transform() is called only once the sliders have not moved for a while.
+        Nothing is done if live update is disabled, the models are then moved only when Apply or Enter is pressed
+        :param self: the reference to the Form
+        """
+        self.timer.Stop()
+        if self.cb_live.Checked:
+            self.timer.Start()
+
+    def timer_tick(self, _sender, _event):
+        """
+        Method invoked when the timer elapses after the last slider movement. It calls transform()
+        :param self: the reference to the Form
+        :param _sender:  ignore
+        :param _event: ignore
+        """
+        self.timer.Stop()
         self.transform()
 
     def exit_button_clicked(self, _sender, _event):
@@ -656,6 +740,7 @@ class TuneModelsForm(Form):
         :param _sender:  ignore
         :param _event: ignore
         """
+        self.timer.Stop()
         if 'colthreads' in globals():
             if platform.python_implementation()=="IronPython":
                 for th in colthreads:
@@ -681,6 +766,7 @@ class TuneModelsForm(Form):
         """
         global flip
         flip = not flip
+        self.timer.Stop()  # supersedes any pending slider transformation
         self.transform()
 
     def apply_button_clicked(self, _sender, _event):
@@ -690,6 +776,7 @@ class TuneModelsForm(Form):
         :param _sender:  ignore
         :param _event: ignore
         """
+        self.timer.Stop()  # supersedes any pending slider transformation
         self.transform()
 
     def beamset_button_clicked(self, _sender, _event):
@@ -723,149 +810,122 @@ class TuneModelsForm(Form):
         or when slider is moved so that text box is updated
         :param self: reference to the Form
         """
-
-        # Get transformation from text box
-        ba = self.tboxB.Text
-        ca = self.tboxC.Text
-        x = self.tboxX.Text
-        y = self.tboxY.Text
-        z = self.tboxZ.Text
-        e = self.tboxE.Text if extraction else "0"
-
-        # Sanity check that we are in the correct range
+        # Get transformation from text boxes, and sanity check that we are in the correct range of each trackbar
         ok = True
-        if ba == "" or float(ba) < self.tbB.Minimum:
-            ba = str(int(self.tbB.Minimum))
-            self.tboxB.Text = ba
-            ok = False
-        if ca == "" or float(ca) < self.tbC.Minimum:
-            ca = str(int(self.tbC.Minimum))
-            self.tboxC.Text = ca
-            ok = False
-        if x == "" or float(x) < self.tbX.Minimum:
-            x = str(int(self.tbX.Minimum))
-            self.tboxX.Text = x
-            ok = False
-        if y == "" or float(y) < self.tbY.Minimum:
-            y = str(int(self.tbY.Minimum))
-            self.tboxY.Text = y
-            ok = False
-        if z == "" or float(z) < self.tbZ.Minimum:
-            z = str(int(self.tbZ.Minimum))
-            self.tboxZ.Text = z
-            ok = False
-        if extraction:
-            if e == "" or float(e) < self.tbE.Minimum:
-                e = str(int(self.tbE.Minimum))
-                self.tboxE.Text = e
-                ok = False
-        if float(ba) > self.tbB.Maximum:
-            ba = str(int(self.tbB.Maximum))
-            self.tboxB.Text = ba
-            ok = False
-        if float(ca) > self.tbC.Maximum:
-            ca = str(int(self.tbC.Maximum))
-            self.tboxC.Text = ca
-            ok = False
-        if float(x) > self.tbX.Maximum:
-            x = str(int(self.tbX.Maximum))
-            self.tboxX.Text = x
-            ok = False
-        if float(y) > self.tbY.Maximum:
-            y = str(int(self.tbY.Maximum))
-            self.tboxY.Text = y
-            ok = False
-        if float(z) > self.tbZ.Maximum:
-            z = str(int(self.tbZ.Maximum))
-            self.tboxZ.Text = z
-            ok = False
-        if extraction:
-            if float(e) > self.tbE.Maximum:
-                e = str(int(self.tbE.Maximum))
-                self.tboxE.Text = e
+        values = []
+        for tbox, tb in self.fields:
+            value = tbox.Text
+            try:
+                number = float(value)
+            except ValueError:
+                number = None
+            if number is None or number < tb.Minimum:
+                value = str(int(tb.Minimum))
+            elif number > tb.Maximum:
+                value = str(int(tb.Maximum))
+            if value != tbox.Text:
+                tbox.Text = value
                 ok = False
+            values.append(value)
+        ba, ca, x, y, z = values[:5]
+        e = values[5] if extraction else "0"
 
         self.update_sliders()  # Update slider position
 
         # If input value was in correct interval, perform the transformation
         if ok:
-            global gangle, oldgangle
-            global cangle, oldcangle
-            global bangle, oldbangle
-            global tangle, oldtangle
-            global cx, oldcx
-            global cy, oldcy
-            global cz, oldcz
-            global se, oldse
-            global coltag, oldcoltag
-            oldgangle = gangle
-            oldcangle = cangle
-            oldbangle = bangle
-            oldtangle = tangle
-            oldcx = cx
-            oldcy = cy
-            oldcz = cz
-            oldse = se
-            gangle = radians(float(ba))
-            cangle = radians(float(ca))
-            bangle = 0  # to be determined later
-            tangle = 0  # to be determined later
-            cx = float(x)
-            cy = float(y)
-            cz = float(z)
-            se = float(e)
-            # Convert couch deviation to cm (RayStation coordinates)
-            cx /= 10.
-            cy /= 10.
-            cz /= 10.
-            se /= 10.
-            oldcoltag = coltag
-            coltag = ""
+            newcoltag = ""
             for i, colpair in enumerate(self.col_pairs):
-                coltag += colpair[0].SelectedValue + "\t" + colpair[1].SelectedValue + "\t" + str(int(self.col_cb[i].Checked)) + "\n"
+                newcoltag += colpair[0].SelectedValue + "\t" + colpair[1].SelectedValue + "\t" + str(int(self.col_cb[i].Checked)) + "\n"
+
+            # Nothing to do if the values are the same than in the last transformation, e.g. Apply clicked twice.
+            # flip is part of the request, since the Flip button changes the scissor pose without touching any text box
+            request = (float(ba), float(ca), float(x), float(y), float(z), float(e), flip, newcoltag)
+            with self.transform_condition:
+                if request == self.queued_request:
+                    return
+                # Replace any request the worker has not started yet, only the latest one matters
+                self.pending_request = (request, [ba, ca, x, y, z, e, newcoltag])
+                self.queued_request = request
+                self.transform_condition.notify_all()
+
+    def transform_loop(self):
+        """
+        Body of the transformation worker thread. It applies the pending requests one at a time, so that each
+        transformation is applied after the previous one, as each of them is relative to the previous pose
+        :param self: reference to the Form
+        """
+        while True:
+            with self.transform_condition:
+                while self.pending_request is None and not self.closing:
+                    self.transform_condition.wait()
+                if self.closing:
+                    return
+                request, arg = self.pending_request
+                self.pending_request = None
+                self.transforming = True
+            ok = False
+            try:
+                apply_transform(arg)
+                ok = True
+            except Exception as ex:
+                print('Transformation of the models failed: ' + str(ex))
+            finally:
+                with self.transform_condition:
+                    self.transforming = False
+                    if ok:
+                        self.last_request = request
+                    elif self.pending_request is None:
+                        self.queued_request = self.last_request  # so that the same values can be applied again
+                    self.transform_condition.notify_all()
+
+    def wait_transforms(self):
+        """
+        Block the calling thread until the transformation worker has applied all the pending requests
+        :param self: reference to the Form
+        """
+        with self.transform_condition:
+            while (self.pending_request is not None or self.transforming) and not self.closing:
+                self.transform_condition.wait()
+
+    def stop_transforms(self, timeout):
+        """
+        Stop the transformation worker once its current transformation, if any, is done
+        :param self: reference to the Form
+        :param timeout: the time in ms to wait for the worker
+        :return: True if the worker is over
+        """
+        with self.transform_condition:
+            self.closing = True
+            self.transform_condition.notify_all()
+        return self.transform_worker.Join(timeout)
 
-            # Transform the models
-            transform_models()
+    def show_beam(self, gantry_angle, couch_angle):
+        """
+        Set the beam and couch angle text boxes to the given beam, and transform the models accordingly
+        :param self: reference to the Form
+        :param gantry_angle: the gantry angle in degrees
+        :param couch_angle: the couch angle in degrees
+        """
+        self.tboxB.Text = str(gantry_angle)
+        self.tboxC.Text = str(couch_angle)
+        self.transform()
 
     def update_sliders(self):
         """
         Update the GUI sliders if after text box input finished.
-        It has to be done without emitting new signal, to avoid an infinite loop
+        It has to be done without emitting new signal, to avoid an infinite loop, so the slider handlers are muted meanwhile
         :param self: reference to Form
         """
-        # Get new values from text box
-        newb = round(float(self.tboxB.Text))
-        newc = round(float(self.tboxC.Text))
-        newx = round(float(self.tboxX.Text))
-        newy = round(float(self.tboxY.Text))
-        newz = round(float(self.tboxZ.Text))
-        newe = round(float(self.tboxE.Text)) if extraction else 0
-        # If different from trackbar value, disconnect temporarily from slots and update the value
-        if abs(newb-self.tbB.Value) > 0:
-            self.tbB.ValueChanged -= self.updatetbox_b
-            self.tbB.Value = newb
-            self.tbB.ValueChanged += self.updatetbox_b
-        if abs(newc - self.tbC.Value) > 0:
-            self.tbC.ValueChanged -= self.updatetbox_c
-            self.tbC.Value = newc
-            self.tbC.ValueChanged += self.updatetbox_c
-        if abs(newx - self.tbX.Value) > 0:
-            self.tbX.ValueChanged -= self.updatetbox_x
-            self.tbX.Value = newx
-            self.tbX.ValueChanged += self.updatetbox_x
-        if abs(newy - self.tbY.Value) > 0:
-            self.tbY.ValueChanged -= self.updatetbox_y
-            self.tbY.Value = newy
-            self.tbY.ValueChanged += self.updatetbox_y
-        if abs(newz - self.tbZ.Value) > 0:
-            self.tbZ.ValueChanged -= self.updatetbox_z
-            self.tbZ.Value = newz
-            self.tbZ.ValueChanged += self.updatetbox_z
-        if extraction:
-            if abs(newe - self.tbE.Value) > 0:
-                self.tbE.ValueChanged -= self.updatetbox_e
-                self.tbE.Value = newe
-                self.tbE.ValueChanged += self.updatetbox_e
+        self.updating_sliders = True
+        try:
+            for tbox, tb in self.fields:
+                # Get new value from text box, and update the trackbar if it differs
+                newvalue = int(round(float(tbox.Text)))
+                if newvalue != tb.Value:
+                    tb.Value = newvalue
+        finally:
+            self.updating_sliders = False
 
 
 def tune_models():
@@ -876,53 +936,247 @@ def tune_models():
     global aform
     aform = TuneModelsForm()
     Application.Run(aform)
-    # Form closed, remove now imported ROIs
-    remove_models()
+    # Form closed. Stop the transformations, the beamset stepping and the collision checks, which still use the imported ROIs,
+    # then remove them. A thread blocked in RayStation cannot be aborted, so the ROIs are left in place if it is still running,
+    # and the next run of this script offers to delete them
+    stopped = aform.stop_transforms(1000)
+    if 'beamthread' in globals():
+        stopped = stop_thread(beamthread) and stopped
+    if 'colthreads' in globals():
+        for th in colthreads:
+            stopped = stop_thread(th) and stopped
+    if stopped:
+        remove_models()
+    else:
+        print('Some threads are still running, the imported models are not removed')
+
+
+def stop_thread(th, timeout=1000):
+    """
+    This function interrupts a thread, aborts it if it does not finish within 100 ms, and waits a bit until it is over
+    :param th: the System.Threading.Thread to stop
+    :param timeout: the time in ms to wait for the thread once aborted
+    :return: True if the thread is over
+    """
+    if th.IsAlive:
+        th.Interrupt()
+        if not th.Join(100):
+            th.Abort()
+            return th.Join(timeout)
+    return True
+
+
+# The sliders only produce integer angles, so their cosines and sines are tabulated once, see cos_sin()
+COS_DEG = tuple(cos(radians(i)) for i in range(-720, 721))
+SIN_DEG = tuple(sin(radians(i)) for i in range(-720, 721))
+
+
+def cos_sin(angle):
+    """
+    This function returns the cosine and sine of an angle, looking them up in COS_DEG and SIN_DEG if it is an integer number of degrees
+    :param angle: the angle in radians
+    :return: a tuple with the cosine and the sine of the angle
+    """
+    deg = degrees(angle)
+    ideg = int(round(deg))
+    if abs(deg - ideg) < 1e-9 and -720 <= ideg <= 720:
+        return COS_DEG[ideg + 720], SIN_DEG[ideg + 720]
+    # Non integer values typed in the text boxes
+    return cos(angle), sin(angle)
+
+
+# TransformationMatrix dictionaries reused by transform_models(), which only reassigns the elements that change.
+# The last row M41..M44 is always 0, 0, 0, 1 and is never written again
+transformation_matrix = {'M11': 1, 'M12': 0, 'M13': 0, 'M14': 0,
+                         'M21': 0, 'M22': 1, 'M23': 0, 'M24': 0,
+                         'M31': 0, 'M32': 0, 'M33': 1, 'M34': 0,
+                         'M41': 0, 'M42': 0, 'M43': 0, 'M44': 1}
+translation_matrix = dict(transformation_matrix)
+
+# Treatment head matrices already computed, see head_matrix()
+head_matrix_cache = {}
+head_matrix_cache_size = 1024
+
+
+def rotation_z(a):
+    """
+    :param a: the rotation angle around the z axis in radians
+    :return: the 4x4 affine matrix R_z(a) as a list of rows
+    """
+    ca, sa = cos_sin(a)
+    return [[ca, -sa, 0, 0],
+            [sa,  ca, 0, 0],
+            [0 ,  0 , 1, 0],
+            [0 ,  0 , 0, 1]]
+
+
+def rotation_y(b):
+    """
+    :param b: the rotation angle around the y axis in radians
+    :return: the 4x4 affine matrix R_y(b) as a list of rows
+    """
+    cb, sb = cos_sin(b)
+    return [[cb, 0, -sb, 0],
+            [0 , 1,  0 , 0],
+            [sb, 0,  cb, 0],
+            [0 , 0,  0 , 1]]
+
+
+def translation(x, y, z):
+    """
+    :param x: the translation along the x axis
+    :param y: the translation along the y axis
+    :param z: the translation along the z axis
+    :return: the 4x4 affine matrix T(x,y,z) as a list of rows
+    """
+    return [[1, 0, 0, x],
+            [0, 1, 0, y],
+            [0, 0, 1, z],
+            [0, 0, 0, 1]]
+
+
+def matmul(*matrices):
+    """
+    :param matrices: the 4x4 matrices to multiply, as lists of rows
+    :return: their product, from left to right
+    """
+    result = matrices[0]
+    for m in matrices[1:]:
+        result = [[r[0]*m[0][j] + r[1]*m[1][j] + r[2]*m[2][j] + r[3]*m[3][j] for j in range(4)] for r in result]
+    return result
+
+
+def transformation_dict(m):
+    """
+    :param m: a 4x4 affine matrix, as a list of rows
+    :return: the same matrix as the M11..M44 dictionary expected by RayStation in its TransformationMatrix arguments
+    """
+    return dict(('M{}{}'.format(i+1, j+1), m[i][j]) for i in range(4) for j in range(4))
+
+
+def head_matrix(oldg, g, oldc, c):
+    """
+    This function computes the elements of the TransformationMatrix D that moves the treatment head from the previous gantry and couch angles to the new ones.
+    The result is cached, as moving the sliders back and forth visits the same angles again and again
+    :param oldg: the previous gantry angle in radians
+    :param g: the new gantry angle in radians
+    :param oldc: the previous couch angle in radians
+    :param c: the new couch angle in radians
+    :return: a tuple with the rotation and translation elements M11 to M34 of D, without retraction,
+    followed by the direction along which the last column moves per unit of retraction ey
+    """
+    key = (round(oldg, 6), round(g, 6), round(oldc, 6), round(c, 6), iso.x, iso.y, iso.z)
+    m = head_matrix_cache.get(key)
+    if m is None:
+        b = -(cs*oldc + c0s)
+        b2 = cs*c + c0s
+        a2 = gs*g
+        d = gs*(g - oldg)  # g0 cancels
+        # D = T(iso) * R_y(b2) * R_z(d) * R_y(b) * T(-iso), see the header of this file
+        rb2 = rotation_y(b2)
+        D = matmul(translation(iso.x, iso.y, iso.z), rb2, rotation_z(d), rotation_y(b), translation(-iso.x, -iso.y, -iso.z))
+        # A retraction ey is a translation T(0,-ey,0) of the part before the new gantry and couch rotation
+        R = matmul(rb2, rotation_z(a2))
+        m = tuple(D[0] + D[1] + D[2]) + (-R[0][1], -R[1][1], -R[2][1])
+        if len(head_matrix_cache) >= head_matrix_cache_size:
+            head_matrix_cache.clear()
+        head_matrix_cache[key] = m
+    return m
+
+
+def apply_transform(arg):
+    """
+    This function updates the gantry and couch state with the values entered in the GUI form and transforms the models accordingly.
+    It is called by the transformation worker thread of TuneModelsForm, one transformation at a time, as each of them is
+    relative to the previous one
+    :param arg: a list with the text of the beam angle, couch angle, couch x, y, z, and snout extraction boxes,
+    followed by the collision tag of the selected collision pairs
+    """
+    ba, ca, x, y, z, e, newcoltag = arg
+    global gangle, oldgangle
+    global cangle, oldcangle
+    global bangle, oldbangle
+    global tangle, oldtangle
+    global cx, oldcx
+    global cy, oldcy
+    global cz, oldcz
+    global se, oldse
+    global coltag, oldcoltag
+    oldgangle = gangle
+    oldcangle = cangle
+    oldbangle = bangle
+    oldtangle = tangle
+    oldcx = cx
+    oldcy = cy
+    oldcz = cz
+    oldse = se
+    gangle = radians(float(ba))
+    cangle = radians(float(ca))
+    bangle = 0  # to be determined later
+    tangle = 0  # to be determined later
+    cx = float(x)
+    cy = float(y)
+    cz = float(z)
+    se = float(e)
+    # Convert couch deviation to cm (RayStation coordinates)
+    cx /= 10.
+    cy /= 10.
+    cz /= 10.
+    se /= 10.
+    oldcoltag = coltag
+    coltag = newcoltag
+
+    # Transform the models, then check the collisions. There is no CompositeAction here, as this runs on the worker thread
+    moved = transform_models()
+    if moved:
+        start_collision_threads()
 
 
 def transform_models():
     """
     This function transforms the imported 3D models to match a new gantry and couch angle, or couch position
+    :return: True if any model moved or the selected collision pairs changed, so that the collision detection has to be repeated
     """
     # First, rotate the treatment head to the new angle
     moved = False
     if abs(cangle - oldcangle) > 0 or abs(gangle - oldgangle) > 0 or abs(se - oldse) > 0:
-        for part in linac.parts:
-            if part.active:
-                roi_name = part.name
-                b = -cs*(oldcangle+c0)
-                b2 = cs*(cangle+c0)
-                a2 = gs*gangle
-                d = gs*(gangle - oldgangle)  # g0 cancels
-                ey = gs*(se - oldse) if part.retractable else 0
-                case.PatientModel.RegionsOfInterest[roi_name].TransformROI3D(Examination=examination, TransformationMatrix={
-                    'M11': cos(d)*cos(b)*cos(b2)-sin(b)*sin(b2), 'M12': -sin(d)*cos(b2), 'M13': -cos(d)*sin(b)*cos(b2)-cos(b)*sin(b2), 'M14': iso.x-iso.x*(cos(d)*cos(b)*cos(b2)-sin(b)*sin(b2))+iso.y*sin(d)*cos(b2)+iso.z*(cos(d)*sin(b)*cos(b2)+cos(b)*sin(b2))+ ey*sin(a2)*cos(b2),
-                    'M21': sin(d)*cos(b)                       , 'M22':  cos(d)        , 'M23': -sin(d)*sin(b)                       , 'M24': iso.y-iso.x* sin(d)*cos(b)                        -iso.y*cos(d)        +iso.z* sin(d)*sin(b)                        - ey*cos(a2)        ,
-                    'M31': cos(d)*cos(b)*sin(b2)+sin(b)*cos(b2), 'M32': -sin(d)*sin(b2), 'M33': -cos(d)*sin(b)*sin(b2)+cos(b)*cos(b2), 'M34': iso.z-iso.x*(cos(d)*cos(b)*sin(b2)+sin(b)*cos(b2))+iso.y*sin(d)*sin(b2)+iso.z*(cos(d)*sin(b)*sin(b2)-cos(b)*cos(b2))+ ey*sin(a2)*sin(b2),
-                    'M41': 0                                   , 'M42':  0             , 'M43':  0                                   , 'M44': 1                                                                                                                      })
+        m11, m12, m13, m14, m21, m22, m23, m24, m31, m32, m33, m34, ex, ey, ez = head_matrix(oldgangle, gangle, oldcangle, cangle)
+        # The same dictionary is filled in place for every part, only the translation depends on the part
+        M = transformation_matrix
+        M['M11'] = m11; M['M12'] = m12; M['M13'] = m13
+        M['M21'] = m21; M['M22'] = m22; M['M23'] = m23
+        M['M31'] = m31; M['M32'] = m32; M['M33'] = m33
+        # The translation of the retractable parts only depends on the snout extraction, so it is computed once for all of them
+        rx, ry, rz = gs*(se - oldse)*ex, gs*(se - oldse)*ey, gs*(se - oldse)*ez
+        for part in head_parts:
+            if part.retractable:
+                M['M14'] = m14 + rx
+                M['M24'] = m24 + ry
+                M['M34'] = m34 + rz
+            else:
+                M['M14'] = m14
+                M['M24'] = m24
+                M['M34'] = m34
+            part.roi.TransformROI3D(Examination=examination, TransformationMatrix=M)
+            moved = True
+    # Then, move the couch to a new position. A couch rotation alone does not move these parts, as it is simulated by rotating the treatment head
+    if abs(cx - oldcx) > 0 or abs(cy - oldcy) > 0 or abs(cz - oldcz) > 0:
+        # The couch displacement is the same for all parts, each part only masks the axes along which it does not move
+        cdx = cx - oldcx
+        cdy = cy - oldcy
+        cdz = cz - oldcz
+        for part in couch_parts:
+            mx, my, mz = part.move_mask
+            dx = cdx*mx
+            dy = cdy*my
+            dz = cdz*mz
+            if abs(dx) > 0 or abs(dy) > 0 or abs(dz) > 0:
+                M = translation_matrix
+                M['M14'] = dx
+                M['M24'] = dy
+                M['M34'] = dz
+                part.roi.TransformROI3D(Examination=examination, TransformationMatrix=M)
                 moved = True
-    # Then, move the couch to a new position
-    if abs(cx - oldcx) > 0 or abs(cy - oldcy) or abs(cz-oldcz) > 0 or abs(cangle-oldcangle) > 0:
-        for part in couch.parts:
-            if part.active:
-                roi_name = part.name
-                dx = cx - oldcx
-                dy = cy - oldcy
-                dz = cz - oldcz
-                if not part.moveX:
-                    dx = 0
-                if not part.moveY:
-                    dy = 0
-                if not part.moveZ:
-                    dz = 0
-                if not part.scissor:
-                    if abs(dx) > 0 or abs(dy) > 0 or abs(dz) > 0:
-                        case.PatientModel.RegionsOfInterest[roi_name].TransformROI3D(Examination=examination, TransformationMatrix={
-                            'M11': 1, 'M12': 0, 'M13': 0, 'M14': dx,
-                            'M21': 0, 'M22': 1, 'M23': 0, 'M24': dy,
-                            'M31': 0, 'M32': 0, 'M33': 1, 'M34': dz,
-                            'M41': 0, 'M42': 0, 'M43': 0, 'M44': 1})
-                        moved = True
 
     if len(lsci) >= 2:  # scissor robot defined. Distances below are hard coded for the moment
         # bangle refers to angle of bottom arm, tangle refers to angle of top arm
@@ -933,10 +1187,12 @@ def transform_models():
         rholim = lt + lb  # cm = 1.2 m plus 1 m
         # Point bx, bz is the anchor point of the bottom arm in the ground (in the pedestal).
         # Note that, in the same way than for the couch, a couch angle is simulated by rotating the room, not the patient or couch
-        bx = iso.x - aO[0]*bs*sin(cangle)
-        bz = iso.z - aO[2]*bs*cos(cangle)
-        oldbx = iso.x - aO[0]*bs*sin(oldcangle)
-        oldbz = iso.z - aO[2]*bs*cos(oldcangle)
+        cc, sc = cos_sin(cangle)
+        oldcc, oldsc = cos_sin(oldcangle)
+        bx = iso.x - aO[0]*bs*sc
+        bz = iso.z - aO[2]*bs*cc
+        oldbx = iso.x - aO[0]*bs*oldsc
+        oldbz = iso.z - aO[2]*bs*oldcc
         # Point tx, tz is the anchor position of the top arm in the couch
         tx = iso.x + dx0 + cx
         tz = iso.z + dz0 + cz
@@ -972,11 +1228,13 @@ def transform_models():
             #print("B",bx,bz, "T",tx,tz,"X",xd,zd,"a_b_c",a,b,c,"alpha_beta_delta",alpha,beta,delta,"bang_tang",bangle,tangle)
 
         if abs(bangle - oldbangle) > 0 or abs(tangle - oldtangle) > 0 or abs(cangle - oldcangle) > 0 or failed:  # if it fails repeatedly, there is no rotation, but we must still perform the action, because the top arm has to follow the anchor point of the moving couch. Otherwise, there will be a small offset when going back to the accepted region, due to jump in the slider
+            parts = dict((p.name, p) for p in couch.parts)
             for i, roi_name in enumerate(lsci):
-                part = [p for p in couch.parts if p.name == roi_name][0]
-                dx = cx - oldcx
-                dy = cy - oldcy
-                dz = cz - oldcz
+                part = parts[roi_name]
+                mx, my, mz = part.move_mask
+                dx = (cx - oldcx)*mx
+                dy = (cy - oldcy)*my
+                dz = (cz - oldcz)*mz
 
                 if i == 0:  # Bottom arm
                     d = -1 * (bangle - oldbangle)  # were already calculated with cs in the formula
@@ -985,18 +1243,11 @@ def transform_models():
                 else:  # Pedestal
                     d = cs * (cangle - oldcangle)
 
-                if not part.moveX:
-                    dx = 0
-                if not part.moveY:
-                    dy = 0
-                if not part.moveZ:
-                    dz = 0
-
                 if i == 0:  # Bottom arm
                     rtpx = oldbx  # rotation point
                     rtpz = oldbz  # rotation point
-                    dx =  -aO[0]*bs*(sin(cangle)-sin(oldcangle))
-                    dz =  -aO[2]*bs*(cos(cangle)-cos(oldcangle))
+                    dx =  -aO[0]*bs*(sc-oldsc)
+                    dz =  -aO[2]*bs*(cc-oldcc)
                 elif i == 1:  # Top arm
                     rtpx = iso.x + dx0 + oldcx
                     rtpz = iso.z + dz0 + oldcz
@@ -1005,62 +1256,89 @@ def transform_models():
                     rtpz = iso.z
                 #print(i,"d",d,"iso",iso.x,iso.z,"couch",cx,cz,"oldcouch",oldcx,oldcy,"rtp",rtpx,rtpz,"dif",dx,dz,"oldif",dx0,dz0)
 
-                case.PatientModel.RegionsOfInterest[roi_name].TransformROI3D(Examination=examination, TransformationMatrix={
-                    'M11': cos(d), 'M12': 0, 'M13': -sin(d), 'M14': rtpx - rtpx*cos(d) + rtpz*sin(d) + dx,
-                    'M21': 0     , 'M22': 1, 'M23': 0      , 'M24': dy,
-                    'M31': sin(d), 'M32': 0, 'M33':  cos(d), 'M34': rtpz - rtpx*sin(d) - rtpz*cos(d) + dz,
-                    'M41': 0     , 'M42': 0, 'M43': 0      , 'M44': 1                                    })
+                cd, sd = cos_sin(d)
+                M = transformation_matrix
+                M['M11'] = cd; M['M12'] = 0; M['M13'] = -sd; M['M14'] = rtpx - rtpx*cd + rtpz*sd + dx
+                M['M21'] = 0 ; M['M22'] = 1; M['M23'] = 0  ; M['M24'] = dy
+                M['M31'] = sd; M['M32'] = 0; M['M33'] = cd ; M['M34'] = rtpz - rtpx*sd - rtpz*cd + dz
+                part.roi.TransformROI3D(Examination=examination, TransformationMatrix=M)
                 moved = True
 
     if coltag != oldcoltag:
         moved = True
 
-    if moved:
-        # Global collision detection thread
-        if 'colthreads' not in globals():
-            global colthreads
+    return moved
+
+
+def start_collision_threads():
+    """
+    This function (re)starts the collision detection threads for the collision pairs selected in the GUI form, once the models have moved
+    """
+    # Global collision detection thread
+    if 'colthreads' not in globals():
+        global colthreads
+    else:
+        if platform.python_implementation()=="IronPython":
+            for th in colthreads:
+                if th.IsAlive:
+                    th.Interrupt()
+                    if th.IsAlive and not th.Join(100):
+                        th.Abort()
         else:
-            if platform.python_implementation()=="IronPython":
-                for th in colthreads:
-                    if th.IsAlive:
-                        th.Interrupt()
-                        if th.IsAlive and not th.Join(100):
-                            th.Abort()
+            for th in colthreads:
+                if th.is_alive():
+                    th.Interrupt()
+                    if th.is_alive() and not th.join(100):
+                        th.Abort()
+
+    if len(coltag) == maxColThreads * 6:  # If nothing selected, just separators " \t \t0\n" for each row, remove everything
+        for labels in aform.reports:
+            clear_labels(labels)
+    else:
+        colthreads = []
+        colpairs = coltag.split('\n')
+        colpairs = colpairs[:-1]  # Remove last element in list which is empty due to trailing \n
+        for idx, colpair in enumerate(colpairs):
+            roia, roib, enable = colpair.split('\t')
+            if int(enable) != 0 and roi_exists(roia) and roi_exists(roib):
+                colthreads.append(Thread(ParameterizedThreadStart(detect_collision)))
+                colthreads[-1].Start(str(idx) + '\t' + roia + '\t' + roib)
             else:
-                for th in colthreads:
-                    if th.is_alive():
-                        th.Interrupt()
-                        if th.is_alive() and not th.join(100):
-                            th.Abort()
+                clear_labels(aform.reports[idx])
+
+
+def clear_labels(labels):
+    """
+    This function clears the text of the given report labels on the form thread, as it is called from the transformation worker
+    :param labels: the labels of a row of the collision report
+    """
+    def clear():
+        for label in labels:
+            label.Text = ''
+    aform.BeginInvoke(Action(clear))
 
-        if len(coltag) == maxColThreads * 6:  # If nothing selected, just separators " \t \t0\n" for each row, remove everything
-            for labels in aform.reports:
-                for label in labels:
-                    label.Text = ''
-        else:
-            colthreads = []
-            colpairs = coltag.split('\n')
-            colpairs = colpairs[:-1]  # Remove last element in list which is empty due to trailing \n
-            roi_lst = [r.Name for r in case.PatientModel.RegionsOfInterest]
-            for idx, colpair in enumerate(colpairs):
-                roia, roib, enable = colpair.split('\t')
-                if roia in roi_lst and roib in roi_lst and int(enable) != 0:
-                    colthreads.append(Thread(ParameterizedThreadStart(detect_collision)))
-                    colthreads[-1].Start(str(idx) + '\t' + roia + '\t' + roib)
-                else:
-                    for label in aform.reports[idx]:
-                        label.Text = ''
+
+def roi_exists(roi_name):
+    """
+    This function checks if an ROI is defined in the case, by looking it up by its name instead of listing all ROI names
+    :param roi_name: the name of the ROI
+    :return: True if the ROI exists
+    """
+    try:
+        case.PatientModel.RegionsOfInterest[roi_name]
+        return True
+    except:
+        return False
 
 
 def remove_models():
     """
     This function remove the ROIs created at the beginning of the script, to clean up everything upon script termination
     """
-    for part in itertools.chain(linac.parts, couch.parts):
-        if part.active:
-            # delete ROI
-            roi_name = part.name
-            case.PatientModel.RegionsOfInterest[roi_name].DeleteRoi()
+    for part in model_parts:
+        # delete ROI
+        part.roi.DeleteRoi()
+        part.roi = None
 
 
 def await_col_report(arg):
@@ -1091,9 +1369,10 @@ def await_col_report(arg):
                     gantry_angle = gantry_angle % 360
                     sampling_angles.append(gantry_angle)
             for sgangle in sampling_angles:
-                arg.tboxB.Text = str(sgangle)
-                arg.tboxC.Text = str(couch_angle)
-                arg.transform()
+                # The text boxes and sliders are updated on the form thread, then this thread waits until the
+                # transformation worker has moved the models
+                arg.EndInvoke(arg.BeginInvoke(Action(lambda: arg.show_beam(sgangle, couch_angle))))
+                arg.wait_transforms()
                 if 'colthreads' in globals():
                     if platform.python_implementation()=="IronPython":
                         while any([th.IsAlive for th in colthreads]):
@@ -1108,6 +1387,8 @@ def await_col_report(arg):
         print('Beamset interrupted')
     except ThreadAbortException:
         print('Beamset aborted')
+    except Exception as ex:
+        print('Beamset failed: ' + str(ex))
     finally:
         print('Beamset done')
 
@@ -1233,21 +1514,22 @@ def main():
     # A rotation angle offset in degrees of the 3D model is needed to match the CT orientation depending on PatientPosition attribute
     # Also, a correction of the rotation direction is needed depending on the patient orientation.
     # TODO: change this and read instead the PatientOrientationMatrix from the DICOM CT
-    gantry_angle_offset = {'HFS': 180, 'FFS': 180, 'HFP':   0, 'FFP':  0}
-    couch_angle_offset =  {'HFS': 180, 'FFS':   0, 'HFP': 180, 'FFP':  0}
-    gantry_direction =    {'HFS':  -1, 'FFS':  -1, 'HFP':  -1, 'FFP': -1}
-    couch_direction =     {'HFS':  -1, 'FFS':  -1, 'HFP':   1, 'FFP':  1}
-    axes_signs =          {'HFS':  [1,1,1], 'FFS':  [-1,1,-1], 'HFP':   [-1,-1,1], 'FFP':  [1,-1,-1]}
+    # For each orientation: gantry angle offset, couch angle offset, gantry direction, couch direction and axes signs
+    orientations = {'HFS': (180, 180, -1, -1, [ 1, 1, 1]),
+                    'FFS': (180,   0, -1, -1, [-1, 1,-1]),
+                    'HFP': (  0, 180, -1,  1, [-1,-1, 1]),
+                    'FFP': (  0,   0, -1,  1, [ 1,-1,-1])}
     # g0, c0 are the needed gantry angle and couch angle rotation of the 3D model to match this patient orientation
     # gs, cs are the rotation direction signs to be applied in order to match this patient orientation
     # aO is the three axes signs to be applied to match this patient orientation
     # cs is redundant with -aO[1] but we keep it for convenience
-    global g0, c0, gs, cs, aO
-    g0 = radians(gantry_angle_offset[orientation])
-    c0 = radians(couch_angle_offset[orientation])
-    gs = gantry_direction[orientation]
-    cs = couch_direction[orientation]
-    aO = axes_signs[orientation]
+    # g0s, c0s are the offsets with their rotation signs already applied
+    global g0, c0, gs, cs, aO, g0s, c0s
+    gantry_angle_offset, couch_angle_offset, gs, cs, aO = orientations[orientation]
+    g0 = radians(gantry_angle_offset)
+    c0 = radians(couch_angle_offset)
+    g0s = gs*g0
+    c0s = cs*c0
 
     # Define the list of available treatment heads
     # https://stackoverflow.com/questions/1867861/how-to-keep-keys-values-in-same-order-as-declared
@@ -1293,27 +1575,29 @@ def main():
     pcform = SelectPartsForm(couch)
     Application.Run(pcform)
 
+    # Keep the selected parts, which are the only ones imported, moved and removed afterwards
+    linac.active_parts = [p for p in linac.parts if p.active]
+    couch.active_parts = [p for p in couch.parts if p.active]
+    global model_parts
+    model_parts = linac.active_parts + couch.active_parts
+
     # Check if Isocenter has already been defined, if not, wait until defined, then continue
     poi_type = 'Isocenter'
-    poi_lst = [r.Type for r in case.PatientModel.PointsOfInterest]
-    while poi_type not in poi_lst:
+    while not any(r.Type == poi_type for r in case.PatientModel.PointsOfInterest):
         await_user_input('Please click OK and define an "'+poi_type+'" POI in the Patient Modelling Tab, then click on Play Script')
-        poi_lst = [r.Type for r in case.PatientModel.PointsOfInterest]
+    isocenters = [r.Name for r in case.PatientModel.PointsOfInterest if r.Type == poi_type]
 
     # If there are more than one isocenter, ask the user to confirm which one to use
     global iso
-    if poi_lst.count(poi_type) > 1:
-        isocenters = [r.Name for r in case.PatientModel.PointsOfInterest if r.Type == poi_type]
-        #print(isocenters)
+    if len(isocenters) > 1:
         isolist = {isocenters[i]: i for i in range(0, len(isocenters))}
-        #print(isolist)
         isoform = SelectListForm(isolist, "Isocenter")
         Application.Run(isoform)
         iso = structure_set.PoiGeometries[isoform.name].Point
     else:
-        iso = structure_set.PoiGeometries[poi_lst.index(poi_type)].Point
+        iso = structure_set.PoiGeometries[isocenters[0]].Point
 
-    # Create first model at angles g=0,c=0.
+    # Create first model at the angles of the first beam in the beamset, if any, otherwise at g=0,c=0.
     # These below are global variables describing gantry angle (gangle), couch angle (cangle), couch position (cx,cy,cz)
     # snout extration (se), and the old value before changing it.
     # tangle, bangle, lsci and flip are used just for scissor robot
@@ -1325,10 +1609,22 @@ def main():
     global lsci
     gangle = 0
     cangle = 0
+    if beamset is not None:
+        for beam in beamset.Beams:
+            gangle = radians(beam.GantryAngle)
+            try:  # https://github.com/mghro/rad-collision/issues/18
+                couch_angle = beam.CouchRotationAngle  # RayStation 9B and higher
+            except:
+                couch_angle = beam.CouchAngle  # legacy
+            couch_angle = (couch_angle + 180) % 360 - 180  # e.g. 270 is -90 in the couch slider range
+            # The scissor robot joints are computed relative to a zero couch angle, so it starts there
+            if abs(couch_angle) <= 90 and not any(p.scissor for p in couch.active_parts):
+                cangle = radians(couch_angle)
+            break
     bangle = 0
     tangle = 0
-    oldgangle = 0
-    oldcangle = 0
+    oldgangle = gangle
+    oldcangle = cangle
     oldbangle = 0
     oldtangle = 0
     cx = 0
@@ -1346,19 +1642,21 @@ def main():
 
     # Remove previous ROIs if already defined, e.g. if previous program instance crashed or script was stopped. This prevents an error later when importing.
     # User is asked for individual removal confirmation, just in case someone defined a clinical ROI with by chance the same name than your model.
-    roi_lst = [r.Name for r in case.PatientModel.RegionsOfInterest]
-    for part in itertools.chain(linac.parts, couch.parts):
-        if part.active:
-            roi_name = part.name
-            if roi_name in roi_lst:
-                await_user_input('Confirm deletion of preexisting ROI "' + roi_name + '" by clicking on Resume Script. Otherwise click Stop Script.')
-                # If this happens because previous script instance was stopped abruptly, so that imported ROIs were not erased, just click on Resume
-                # If this happens because planner defined an ROI with same name as imported model, click stop and rename 3D model, or the planner contoured ROI
-                case.PatientModel.RegionsOfInterest[roi_name].DeleteRoi()
-
-    # Create now treatment head ROIs and import STL models. Gantry and couch angle will be zero, and model will be centered at iso
-    for part in linac.parts:
-        if part.active:
+    for part in model_parts:
+        roi_name = part.name
+        if roi_exists(roi_name):
+            await_user_input('Confirm deletion of preexisting ROI "' + roi_name + '" by clicking on Resume Script. Otherwise click Stop Script.')
+            # If this happens because previous script instance was stopped abruptly, so that imported ROIs were not erased, just click on Resume
+            # If this happens because planner defined an ROI with same name as imported model, click stop and rename 3D model, or the planner contoured ROI
+            case.PatientModel.RegionsOfInterest[roi_name].DeleteRoi()
+
+    # Create now treatment head ROIs and import STL models. They are placed directly at the initial gantry and couch angle, and centered at iso,
+    # i.e. with TransformationMatrix M(iso.x,iso.y,iso.z,c,g), so that they do not need to be transformed again afterwards
+    head_import_matrix = transformation_dict(matmul(translation(iso.x, iso.y, iso.z), rotation_y(cs*cangle + c0s), rotation_z(gs*gangle + g0s)))
+    couch_import_matrix = transformation_dict(matmul(translation(iso.x, iso.y, iso.z), rotation_y(c0s), rotation_z(g0s)))
+    # All ROIs are created and imported in a single RayStation action
+    with CompositeAction('Import models'):
+        for part in linac.active_parts:
             # create ROI
             roi_name = part.name
             roi_color = part.color
@@ -1367,20 +1665,14 @@ def main():
             if not os.path.isfile(file_name):
                 raise NameError(file_name,'not found. Check STL data path in the script.')
             case.PatientModel.CreateRoi(Name=roi_name, Color=roi_color, Type=roi_type)
+            part.roi = case.PatientModel.RegionsOfInterest[roi_name]  # keep the handle, to avoid looking it up at each transformation
             # import mesh from file
             geo = structure_set.RoiGeometries[roi_name]
-            a = gs*g0
-            b = cs*c0
-            geo.ImportRoiGeometryFromSTL(FileName=file_name, UnitInFile='Millimeter',
-                                         TransformationMatrix={'M11': cos(a)*cos(b), 'M12': -sin(a)*cos(b), 'M13': -sin(b), 'M14': iso.x,
-                                                               'M21': sin(a)       , 'M22':  cos(a)       , 'M23':       0, 'M24': iso.y,
-                                                               'M31': cos(a)*sin(b), 'M32': -sin(a)*sin(b), 'M33':  cos(b), 'M34': iso.z,
-                                                               'M41':             0, 'M42':              0, 'M43':       0, 'M44':     1})
-
-    # Create now couch ROIs and import STL models. Couch will be centered at iso, but not moved.
-    # Thus, it might be far away from the patient and has to be readjusted with the GUI sliders.
-    for part in couch.parts:
-        if part.active:
+            geo.ImportRoiGeometryFromSTL(FileName=file_name, UnitInFile='Millimeter', TransformationMatrix=head_import_matrix)
+
+        # Create now couch ROIs and import STL models. Couch will be centered at iso, but not moved.
+        # Thus, it might be far away from the patient and has to be readjusted with the GUI sliders.
+        for part in couch.active_parts:
             # create ROI
             roi_name = part.name
             roi_color = part.color
@@ -1389,20 +1681,20 @@ def main():
             if not os.path.isfile(file_name):
                 raise NameError(file_name,'not found. Check STL data path in the script.')
             case.PatientModel.CreateRoi(Name=roi_name, Color=roi_color, Type=roi_type)
+            part.roi = case.PatientModel.RegionsOfInterest[roi_name]  # keep the handle, to avoid looking it up at each transformation
             # import mesh from file
             geo = structure_set.RoiGeometries[roi_name]
-            a = gs*g0
-            b = cs*c0
-            geo.ImportRoiGeometryFromSTL(FileName=file_name, UnitInFile='Millimeter',
-                                         TransformationMatrix={'M11': cos(a)*cos(b), 'M12': -sin(a)*cos(b), 'M13': -sin(b), 'M14': iso.x,
-                                                               'M21': sin(a)       , 'M22':  cos(a)       , 'M23':       0, 'M24': iso.y,
-                                                               'M31': cos(a)*sin(b), 'M32': -sin(a)*sin(b), 'M33':  cos(b), 'M34': iso.z,
-                                                               'M41':             0, 'M42':              0, 'M43':       0, 'M44':     1})
+            geo.ImportRoiGeometryFromSTL(FileName=file_name, UnitInFile='Millimeter', TransformationMatrix=couch_import_matrix)
 
     # Check if a scissor robot is defined and store their part names in a list, being the first element the base, and the second element the top part,
     # and the third element the pedestal, if any
-    auxlist = [p.name for p in couch.parts if p.scissor and p.active]
+    auxlist = [p.name for p in couch.active_parts if p.scissor]
     lsci = []
+    # The active parts that transform_models moves rigidly with the gantry and couch angles, and with the couch translation, respectively.
+    # The scissor parts are moved separately, joint by joint
+    global head_parts, couch_parts
+    head_parts = linac.active_parts
+    couch_parts = [p for p in couch.active_parts if not p.scissor]
     if len(auxlist) >= 2:
         lsci.append([pname for pname in auxlist if "base" in pname][0])
         lsci.append([pname for pname in auxlist if "top" in pname][0])
@@ -1411,7 +1703,7 @@ def main():
     # Get list contoured couch ROIs here, ie. whose name contain couch (case insensitive)
     couch_lst = [r.Name for r in case.PatientModel.RegionsOfInterest if r.Type == 'Support' if re.search('couch', r.Name, re.IGNORECASE)]
     # Get list of couch STL 3D models, ie. whose name contain couch (case insensitive)
-    couch_models = [c.name for c in couch.parts if c.active if re.search('couch', c.name, re.IGNORECASE)]
+    couch_models = [c.name for c in couch.active_parts if re.search('couch', c.name, re.IGNORECASE)]
 
     # If there is a Couch ROI that someone contoured on the CT, recenter couch parts to match it approximately.
     # This is implemented by looking for the first occurrence ROI or model containing the substring couch.
@@ -1439,34 +1731,23 @@ def main():
             dx0 = rx-mx
             dy0 = ry-my
             dz0 = rz-mz
-            for part in couch.parts:
-                if part.active:
-                    roi_name = part.name
-                    dx = dx0
-                    dy = dy0
-                    dz = dz0
-                    if not part.moveX:
-                        dx = 0
-                    if not part.moveY:
-                        dy = 0
-                    if not part.moveZ:
-                        dz = 0
-                    if not part.scissor:
-                        case.PatientModel.RegionsOfInterest[roi_name].TransformROI3D(Examination=examination, TransformationMatrix={
-                            'M11': 1, 'M12': 0, 'M13': 0, 'M14': dx,
-                            'M21': 0, 'M22': 1, 'M23': 0, 'M24': dy,
-                            'M31': 0, 'M32': 0, 'M33': 1, 'M34': dz,
-                            'M41': 0, 'M42': 0, 'M43': 0, 'M44': 1})
-                    else:
-                        case.PatientModel.RegionsOfInterest[roi_name].TransformROI3D(Examination=examination, TransformationMatrix={
-                            'M11': 1, 'M12': 0, 'M13': 0, 'M14': dx,
-                            'M21': 0, 'M22': 1, 'M23': 0, 'M24': dy,
-                            'M31': 0, 'M32': 0, 'M33': 1, 'M34': dz,
-                            'M41': 0, 'M42': 0, 'M43': 0, 'M44': 1})
+            for part in couch.active_parts:
+                mx, my, mz = part.move_mask
+                dx = dx0*mx
+                dy = dy0*my
+                dz = dz0*mz
+                if dx == 0 and dy == 0 and dz == 0:
+                    continue  # e.g. a fixed base, it would be an identity transformation
+                # Scissor parts are translated in the same way here
+                M = translation_matrix
+                M['M14'] = dx
+                M['M24'] = dy
+                M['M34'] = dz
+                part.roi.TransformROI3D(Examination=examination, TransformationMatrix=M)
 
     # Check if any element of the modelled ones is a rectractable snout or range shifter
     global extraction
-    extraction = any([part.retractable for part in linac.parts if part.active])
+    extraction = any(part.retractable for part in linac.active_parts)
 
     # Check the maximum number of threads (roiA : roiB combinations) to allow for collision detection
     global maxColThreads